@@ -3,91 +3,442 @@ FastAPI OIDC Middleware for Keycloak Authentication
 
 This middleware validates JWT tokens from Keycloak using the JWKS endpoint.
 It supports token validation, role checking, and user context injection.
+
+Consume it through FastAPI dependencies (``Depends(keycloak_auth.require_auth())``).
+For global enforcement register it as a pure ASGI middleware with
+``app.add_middleware(keycloak_auth.as_asgi_middleware)``; never wrap it in
+Starlette's ``BaseHTTPMiddleware``, which allocates streams, a task group and
+wrapped request/response objects on every request.
 """
 
 import asyncio
+import base64
+import hashlib
+import json
+import logging
+import math
 import time
-from typing import List, Optional, Dict, Any
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any, Protocol, Tuple
 import httpx
 from fastapi import HTTPException, Security, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError, jwk
-from jose.utils import base64url_decode
+from fastapi.responses import JSONResponse
+from jose import JWTError, jwk
+from jose.exceptions import ExpiredSignatureError, JOSEError, JWTClaimsError
+try:
+    from jose.backends.cryptography_backend import CryptographyRSAKey
+except ImportError as error:  # pragma: no cover - depends on installed extras
+    raise ImportError(
+        "The C-backed cryptography backend is required: pip install python-jose[cryptography]"
+    ) from error
+try:
+    from orjson import loads as _json_loads  # Rust-backed, several times faster than json
+except ImportError:  # pragma: no cover - optional speedup
+    _json_loads = json.loads
 import os
+from contextlib import asynccontextmanager
 from functools import lru_cache
 
+logger = logging.getLogger(__name__)
+
+# Accepted signature algorithms
+_ALGS = ('RS256',)
+
+# Seconds to wait before re-reading the shared JWKS while another worker refreshes it
+_SHARED_REFRESH_POLL = 1.0
+
+
+def _b64u(segment: bytes) -> bytes:
+    """Decode an unpadded base64url JWT segment"""
+    return base64.urlsafe_b64decode(segment + b'=' * (-len(segment) % 4))
+
+
+# Single bearer scheme shared by every dependency, so FastAPI resolves it
+# once per request and OpenAPI lists one security scheme
+_BEARER = HTTPBearer(auto_error=False)
+
+# Shared read-only fallback for missing claims; never handed to callers
+_EMPTY: Dict[str, Any] = {}
+
+
+class JWKSStore(Protocol):
+    """Cross-worker JWKS cache: raw JWKs keyed by kid, plus when they were fetched"""
+    
+    async def get_all(self) -> Optional[Tuple[Dict[str, Dict[str, Any]], float]]:
+        ...
+    
+    async def set_many(self, keys: Dict[str, Dict[str, Any]], fetched_at: float):
+        ...
+    
+    async def acquire_refresh_lock(self) -> bool:
+        """Return True for exactly one caller per lock period; only it fetches from Keycloak"""
+        ...
+    
+    async def aclose(self):
+        ...
+
+
+class RedisJWKSStore:
+    """JWKS cache shared by all workers through Redis (requires `redis`)"""
+    
+    def __init__(self, redis_url: str, realm: str, ttl: int = 300, lock_ttl: int = 10):
+        try:
+            from redis import asyncio as redis_asyncio
+        except ImportError as error:  # pragma: no cover - optional dependency
+            raise ImportError("RedisJWKSStore requires: pip install redis") from error
+        
+        self._redis = redis_asyncio.from_url(redis_url)
+        self.key = f"jwks:{realm}"
+        self.lock_key = f"jwks:{realm}:lock"
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+    
+    async def get_all(self) -> Optional[Tuple[Dict[str, Dict[str, Any]], float]]:
+        """Return the shared JWK set keyed by kid and its fetch time, or None if absent"""
+        raw = await self._redis.get(self.key)
+        if not raw:
+            return None
+        entry = _json_loads(raw)
+        return entry['keys'], entry['fetched_at']
+    
+    async def set_many(self, keys: Dict[str, Dict[str, Any]], fetched_at: float):
+        """Publish a freshly fetched JWK set for the other workers"""
+        entry = {'keys': keys, 'fetched_at': fetched_at}
+        await self._redis.set(self.key, json.dumps(entry), ex=self.ttl)
+    
+    async def acquire_refresh_lock(self) -> bool:
+        """Single-flight across workers; the lock simply expires after lock_ttl"""
+        return bool(await self._redis.set(self.lock_key, b'1', nx=True, ex=self.lock_ttl))
+    
+    async def aclose(self):
+        await self._redis.aclose()
+
+
 class KeycloakOIDCMiddleware:
     def __init__(
         self,
         keycloak_url: str = None,
         realm: str = None,
         client_id: str = None,
-        jwks_cache_ttl: int = 300  # 5 minutes
+        jwks_cache_ttl: int = 300,  # 5 minutes
+        payload_cache_ttl: int = 5,
+        payload_cache_size: int = 4096,
+        jwks_retry_interval: float = 30.0,  # Also spaces out lazy startup retries
+        jwks_store: Optional[JWKSStore] = None
     ):
         self.keycloak_url = keycloak_url or os.getenv('KEYCLOAK_URL', 'http://localhost:8080')
         self.realm = realm or os.getenv('PROJECT_REALM', 'project-realm')
         self.client_id = client_id or os.getenv('PROJECT_WEB_CLIENT_ID', 'project-web')
         self.jwks_cache_ttl = jwks_cache_ttl
         self.oidc_config = None
+        self._issuer: Optional[str] = None
         self.jwks_keys = {}
         self.jwks_last_fetch = 0
-        self.security = HTTPBearer(auto_error=False)
+        self._jwks_lock = asyncio.Lock()
+        self._jwks_refreshing = False
+        self._jwks_refresh_task: Optional[asyncio.Task] = None
+        self._jwks_retry_interval = jwks_retry_interval
+        self._jwks_retry_at = 0.0
+        
+        # Optional cross-worker JWKS cache so only one worker hits Keycloak per TTL
+        redis_url = os.getenv('JWKS_REDIS_URL')
+        if jwks_store is None and redis_url:
+            jwks_store = RedisJWKSStore(redis_url, self.realm, self.jwks_cache_ttl)
+        self._jwks_store = jwks_store
+        # With a shared store, refresh at half the TTL so one worker renews the
+        # shared entry while everyone else still holds valid keys
+        self._jwks_refresh_after = jwks_cache_ttl / 2 if jwks_store is not None else jwks_cache_ttl
+        self._payload_cache_ttl = payload_cache_ttl
+        self._payload_cache_size = payload_cache_size
+        self._payload_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self.security = _BEARER
+        
+        # Long-lived HTTP client so discovery and JWKS refreshes reuse connections
+        self._http = httpx.AsyncClient(
+            http2=True,
+            timeout=5.0,
+            limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)
+        )
         
-        # Initialize async
-        asyncio.create_task(self.init())
+        # Set by startup(); call it from the application's lifespan, otherwise
+        # the first request starts the middleware lazily
+        self._ready = asyncio.Event()
+        self._startup_task: Optional[asyncio.Task] = None
+        self._startup_retry_at = 0.0
     
-    async def init(self):
+    async def startup(self):
         """Initialize OIDC configuration"""
         try:
-            config_url = f"{self.keycloak_url}/realms/{self.realm}/.well-known/openid-configuration"
-            
-            async with httpx.AsyncClient() as client:
-                response = await client.get(config_url)
-                response.raise_for_status()
-                self.oidc_config = response.json()
-            
-            print("✅ Keycloak OIDC middleware initialized")
+            await self._load_oidc_config()
+        except Exception:
+            logger.exception("Failed to initialize Keycloak OIDC middleware")
+            raise
+    
+    async def _load_oidc_config(self):
+        config_url = f"{self.keycloak_url}/realms/{self.realm}/.well-known/openid-configuration"
+        
+        response = await self._http.get(config_url)
+        response.raise_for_status()
+        self.oidc_config = response.json()
+        self._issuer = self.oidc_config['issuer']
+        self._ready.set()
+        
+        logger.info("Keycloak OIDC middleware initialized")
+    
+    async def _lazy_startup(self):
+        """startup() for the first request, backing off after a failed attempt"""
+        try:
+            await self._load_oidc_config()
         except Exception as error:
-            print(f"❌ Failed to initialize Keycloak OIDC middleware: {error}")
-            raise error
+            self._startup_retry_at = time.time() + self._jwks_retry_interval
+            logger.warning(
+                "Failed to initialize Keycloak OIDC middleware, retrying in %ss: %s",
+                self._jwks_retry_interval, error
+            )
+            raise
+    
+    async def _ensure_started(self):
+        """Run startup() once for every request that arrives before it has completed"""
+        if self._startup_task is None or self._startup_task.done():
+            # A finished task without the ready flag means the last attempt failed
+            if time.time() < self._startup_retry_at:
+                raise HTTPException(
+                    status_code=503,
+                    detail="Authentication service not ready"
+                )
+            self._startup_task = asyncio.create_task(self._lazy_startup())
+        try:
+            await asyncio.shield(self._startup_task)
+        except Exception:
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication service not ready"
+            )
+    
+    async def aclose(self):
+        """Close the shared HTTP client and JWKS store"""
+        await self._http.aclose()
+        if self._jwks_store is not None:
+            await self._jwks_store.aclose()
     
     async def get_jwks_keys(self) -> Dict[str, Any]:
-        """Fetch and cache JWKS keys"""
-        current_time = time.time()
+        """Return cached JWKS keys, refreshing them in the background when stale"""
+        if (time.time() - self.jwks_last_fetch) <= self._jwks_refresh_after:
+            return self.jwks_keys
+        
+        if self.jwks_keys:
+            # Serve stale keys immediately; a single task refreshes them, backing
+            # off for a while after a failed attempt
+            if not self._jwks_refreshing and time.time() >= self._jwks_retry_at:
+                self._jwks_refreshing = True
+                self._jwks_refresh_task = asyncio.create_task(self._refresh_jwks())
+            return self.jwks_keys
         
-        if (current_time - self.jwks_last_fetch) > self.jwks_cache_ttl:
+        # Cold start: nothing cached yet, so the caller has to wait
+        await self._refresh_jwks()
+        return self.jwks_keys
+    
+    async def _refresh_jwks(self):
+        """Fetch JWKS keys, allowing only one fetch in flight at a time"""
+        async with self._jwks_lock:
+            self._jwks_refreshing = True
             try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(self.oidc_config['jwks_uri'])
-                    response.raise_for_status()
-                    jwks_data = response.json()
+                # Another coroutine may have refreshed while we waited
+                if (time.time() - self.jwks_last_fetch) <= self._jwks_refresh_after:
+                    return
+                
+                shared = await self._read_shared_jwks()
                 
-                # Convert keys to usable format
-                self.jwks_keys = {}
-                for key_data in jwks_data['keys']:
-                    kid = key_data['kid']
-                    self.jwks_keys[kid] = jwk.construct(key_data)
+                # Keys are aged from when Keycloak served them, not when we read them
+                if shared is not None and (time.time() - shared[1]) <= self._jwks_refresh_after:
+                    # Another worker refreshed recently
+                    key_set, fetched_at = shared
+                elif self.jwks_keys and not await self._acquire_shared_refresh():
+                    # Another worker is fetching from Keycloak: keep our keys, or adopt
+                    # the shared set if it is newer than ours, and look again shortly
+                    self._jwks_retry_at = time.time() + _SHARED_REFRESH_POLL
+                    if shared is None or shared[1] <= self.jwks_last_fetch:
+                        return
+                    key_set, fetched_at = shared
+                else:
+                    response = await self._http.get(self.oidc_config['jwks_uri'])
+                    response.raise_for_status()
+                    fetched_at = time.time()
+                    key_set = {
+                        key_data['kid']: key_data
+                        for key_data in response.json()['keys']
+                        if key_data.get('use', 'sig') == 'sig'  # Skip encryption keys
+                    }
+                    await self._write_shared_jwks(key_set, fetched_at)
                 
-                self.jwks_last_fetch = current_time
-                print("🔄 JWKS keys refreshed")
+                # Build the new key map in one pass and rebind it, so readers never
+                # see a partially populated dict
+                self.jwks_keys = self._construct_keys(key_set)
+                self.jwks_last_fetch = fetched_at
+                logger.info("JWKS keys refreshed (%d keys)", len(self.jwks_keys))
                 
             except Exception as error:
-                print(f"❌ Failed to fetch JWKS keys: {error}")
+                self._jwks_retry_at = time.time() + self._jwks_retry_interval
                 if not self.jwks_keys:  # If no cached keys available
-                    raise error
+                    logger.exception("Failed to fetch JWKS keys")
+                    raise
+                logger.warning(
+                    "Failed to refresh JWKS keys, serving cached keys and retrying in %ss: %s",
+                    self._jwks_retry_interval, error
+                )
+            finally:
+                self._jwks_refreshing = False
+    
+    async def _read_shared_jwks(self) -> Optional[Tuple[Dict[str, Dict[str, Any]], float]]:
+        """Read a still-fresh JWK set published by another worker, if any"""
+        if self._jwks_store is None:
+            return None
+        try:
+            shared = await self._jwks_store.get_all()
+        except Exception:
+            logger.warning("Shared JWKS store unavailable, fetching from Keycloak", exc_info=True)
+            return None
+        if shared is None or (time.time() - shared[1]) > self.jwks_cache_ttl:
+            return None
+        return shared
+    
+    async def _acquire_shared_refresh(self) -> bool:
+        """Win the cross-worker right to fetch from Keycloak (always True without a store)"""
+        if self._jwks_store is None:
+            return True
+        try:
+            return await self._jwks_store.acquire_refresh_lock()
+        except Exception:
+            logger.warning("Shared JWKS lock unavailable, fetching from Keycloak", exc_info=True)
+            return True
+    
+    async def _write_shared_jwks(self, key_set: Dict[str, Dict[str, Any]], fetched_at: float):
+        """Publish a JWK set fetched from Keycloak to the other workers"""
+        if self._jwks_store is None:
+            return
+        try:
+            await self._jwks_store.set_many(key_set, fetched_at)
+        except Exception:
+            logger.warning("Failed to publish JWKS keys to shared store", exc_info=True)
+    
+    @staticmethod
+    def _construct_keys(key_set: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Build verification keys once per kid, keeping only cryptography-backed RSA keys"""
+        keys = {}
+        for kid, key_data in key_set.items():
+            try:
+                key = jwk.construct(key_data, key_data.get('alg', 'RS256'))
+            except JOSEError:
+                key = None
+            if not isinstance(key, CryptographyRSAKey):
+                logger.warning("Skipping JWKS key '%s': not an RSA key backed by cryptography", kid)
+                continue
+            keys[kid] = key
+        return keys
+    
+    @staticmethod
+    def _split_token(token: str) -> Tuple[Dict[str, Any], Dict[str, Any], bytes, bytes, bytes]:
+        """Split and decode a compact JWS once: (header, claims, claims JSON, signing input, signature)"""
+        try:
+            header_b64, claims_b64, signature_b64 = token.encode().split(b'.')
+            header = _json_loads(_b64u(header_b64))
+            claims_json = _b64u(claims_b64)
+            claims = _json_loads(claims_json)
+            signature = _b64u(signature_b64)
+        except ValueError:
+            raise JWTError("Malformed token")
         
-        return self.jwks_keys
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise JWTError("Malformed token")
+        
+        return header, claims, claims_json, header_b64 + b'.' + claims_b64, signature
+    
+    @staticmethod
+    def _int_claim(claims: Dict[str, Any], name: str, message: str) -> int:
+        """Read a NumericDate claim as jose does, truncating to an integer"""
+        try:
+            return int(claims[name])
+        except (TypeError, ValueError, OverflowError):
+            raise JWTClaimsError(message)
+    
+    def _validate_claims(self, claims: Dict[str, Any]) -> Optional[int]:
+        """Check registered claims the way jose.jwt.decode does; returns exp as an integer"""
+        now = int(time.time())
+        exp = None
+        
+        if 'iat' in claims:
+            self._int_claim(claims, 'iat', "Issued At claim (iat) must be an integer.")
+        
+        if 'nbf' in claims:
+            nbf = self._int_claim(claims, 'nbf', "Not Before claim (nbf) must be an integer.")
+            if nbf > now:
+                raise JWTClaimsError("The token is not yet valid (nbf)")
+        
+        if 'exp' in claims:
+            exp = self._int_claim(claims, 'exp', "Expiration Time claim (exp) must be an integer.")
+            if exp < now:
+                raise ExpiredSignatureError("Signature has expired.")
+        
+        if 'aud' in claims:
+            audience = claims['aud']
+            if isinstance(audience, str):
+                audience = [audience]
+            if not isinstance(audience, list) or not all(isinstance(aud, str) for aud in audience):
+                raise JWTClaimsError("Invalid claim format in token")
+            if self.client_id not in audience:
+                raise JWTClaimsError("Invalid audience")
+        
+        if claims.get('iss') != self._issuer:
+            raise JWTClaimsError("Invalid issuer")
+        
+        if 'sub' in claims and not isinstance(claims['sub'], str):
+            raise JWTClaimsError("Subject must be a string.")
+        
+        if 'jti' in claims and not isinstance(claims['jti'], str):
+            raise JWTClaimsError("JWT ID must be a string.")
+        
+        return exp
     
     async def validate_token(self, token: str) -> Dict[str, Any]:
         """Validate JWT token"""
+        # Serve recently verified tokens without repeating RSA verification. The
+        # cache holds the verified claims JSON, so every hit parses a fresh dict
+        # and handlers can never mutate what later requests see
+        token_hash = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        cached = self._payload_cache.get(token_hash)
+        if cached is not None:
+            if cached[0] > time.time():
+                self._payload_cache.move_to_end(token_hash)
+                return _json_loads(cached[1])
+            self._payload_cache.pop(token_hash, None)
+        
+        if not self._ready.is_set():
+            await self._ensure_started()
+        
         try:
-            # Decode header to get kid
-            unverified_header = jwt.get_unverified_header(token)
-            kid = unverified_header.get('kid')
+            # Split and decode every segment once; the kid comes from this header decode
+            header, payload, claims_json, signing_input, signature = self._split_token(token)
+            
+            # Reject clearly expired tokens before paying for RSA verification;
+            # the stdlib json fallback parses NaN/Infinity, so check finiteness first
+            exp = payload.get('exp')
+            if isinstance(exp, float) and not math.isfinite(exp):
+                raise JWTError("Malformed token")
+            if isinstance(exp, (int, float)) and int(exp) < int(time.time()):
+                raise ExpiredSignatureError("Signature has expired.")
+            
+            if header.get('alg') not in _ALGS:
+                raise JWTError("The specified alg value is not allowed")
+            
+            kid = header.get('kid')
             
             if not kid:
                 raise JWTError("Token missing 'kid' in header")
             
+            if not isinstance(kid, str):
+                raise JWTError("Invalid 'kid' in header")
+            
             # Get signing key
             jwks_keys = await self.get_jwks_keys()
             
@@ -96,34 +447,58 @@ class KeycloakOIDCMiddleware:
             
             key = jwks_keys[kid]
             
-            # Verify token
-            payload = jwt.decode(
-                token,
-                key,
-                algorithms=['RS256'],
-                audience=self.client_id,
-                issuer=self.oidc_config['issuer']
-            )
+            # Verify signature, then the registered claims
+            if not key.verify(signing_input, signature):
+                raise JWTError("Signature verification failed.")
+            
+            exp = self._validate_claims(payload)
+            
+            # Cache verified payload, never beyond the token's own expiry
+            expires_at = time.time() + self._payload_cache_ttl
+            if exp is not None:
+                expires_at = min(exp, expires_at)
+            self._payload_cache[token_hash] = (expires_at, claims_json)
+            if len(self._payload_cache) > self._payload_cache_size:
+                self._payload_cache.popitem(last=False)
             
             return payload
             
         except JWTError as error:
+            logger.debug("Token validation failed: %s", error)
             raise HTTPException(
                 status_code=401,
                 detail=f"Token validation failed: {str(error)}"
             )
     
     def has_role(self, user_payload: Dict[str, Any], required_roles: List[str]) -> bool:
-        """Check if user has required roles"""
+        """Check if user has any of the required roles.
+
+        Unspecialized public helper for ad-hoc checks; routes should use
+        require_roles(), which builds its role set once per route.
+        """
         if not required_roles:
             return True
         
-        user_roles = user_payload.get('realm_access', {}).get('roles', [])
-        return any(role in user_roles for role in required_roles)
+        realm_access = user_payload.get('realm_access') or _EMPTY
+        return not frozenset(required_roles).isdisjoint(realm_access.get('roles', ()))
+    
+    @staticmethod
+    def _project_user(payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the user context exposed to route handlers"""
+        realm_access = payload.get('realm_access') or _EMPTY
+        return {
+            'id': payload.get('sub'),
+            'username': payload.get('preferred_username'),
+            'email': payload.get('email'),
+            'name': payload.get('name'),
+            'roles': realm_access.get('roles', []),
+            'client_roles': payload.get('resource_access') or {},
+            'token_payload': payload
+        }
     
     async def get_current_user(
         self,
-        credentials: Optional[HTTPAuthorizationCredentials] = Security(HTTPBearer(auto_error=False))
+        credentials: Optional[HTTPAuthorizationCredentials] = Security(_BEARER)
     ) -> Optional[Dict[str, Any]]:
         """Extract and validate user from token"""
         if not credentials:
@@ -132,15 +507,7 @@ class KeycloakOIDCMiddleware:
         try:
             payload = await self.validate_token(credentials.credentials)
             
-            return {
-                'id': payload.get('sub'),
-                'username': payload.get('preferred_username'),
-                'email': payload.get('email'),
-                'name': payload.get('name'),
-                'roles': payload.get('realm_access', {}).get('roles', []),
-                'client_roles': payload.get('resource_access', {}),
-                'token_payload': payload
-            }
+            return self._project_user(payload)
         except HTTPException:
             return None
     
@@ -157,27 +524,27 @@ class KeycloakOIDCMiddleware:
             
             payload = await self.validate_token(credentials.credentials)
             
-            return {
-                'id': payload.get('sub'),
-                'username': payload.get('preferred_username'),
-                'email': payload.get('email'),
-                'name': payload.get('name'),
-                'roles': payload.get('realm_access', {}).get('roles', []),
-                'client_roles': payload.get('resource_access', {}),
-                'token_payload': payload
-            }
+            return self._project_user(payload)
         
         return _require_auth
     
     def require_roles(self, required_roles: List[str]):
         """Dependency that requires specific roles"""
+        if not required_roles:
+            return self.require_auth()
+        
+        # Specialize the check for this route: the role set, its bound
+        # isdisjoint and the error message are all built once here
+        check = frozenset(required_roles).isdisjoint
+        detail = f"Access denied. Required roles: {', '.join(required_roles)}"
+        
         async def _require_roles(
             current_user: Dict[str, Any] = Depends(self.require_auth())
         ) -> Dict[str, Any]:
-            if not self.has_role(current_user['token_payload'], required_roles):
+            if check(current_user['roles']):
                 raise HTTPException(
                     status_code=403,
-                    detail=f"Access denied. Required roles: {', '.join(required_roles)}"
+                    detail=detail
                 )
             
             return current_user
@@ -187,14 +554,49 @@ class KeycloakOIDCMiddleware:
     def optional_auth(self):
         """Dependency for optional authentication"""
         return self.get_current_user
+    
+    def as_asgi_middleware(self, app):
+        """Wrap an ASGI app, for use with ``app.add_middleware``"""
+        return _AuthASGIMiddleware(app, self)
+
+
+class _AuthASGIMiddleware:
+    """Pure ASGI middleware enforcing authentication on every HTTP request"""
+    
+    def __init__(self, app, auth: KeycloakOIDCMiddleware):
+        self.app = app
+        self.auth = auth
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        token = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                scheme, _, credentials = value.decode("latin-1").partition(" ")
+                if scheme.lower() == "bearer" and credentials:
+                    token = credentials
+                break
+        
+        try:
+            if token is None:
+                raise HTTPException(status_code=401, detail="Authentication required")
+            payload = await self.auth.validate_token(token)
+        except HTTPException as error:
+            response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+        
+        scope.setdefault("state", {})["token_payload"] = payload
+        await self.app(scope, receive, send)
 
 
 # Example FastAPI application
 def create_example_app():
     from fastapi import FastAPI, Depends
     
-    app = FastAPI(title="Keycloak Auth Example")
-    
     # Initialize middleware
     keycloak_auth = KeycloakOIDCMiddleware(
         keycloak_url='http://localhost:8080',
@@ -202,6 +604,14 @@ def create_example_app():
         client_id='project-web'
     )
     
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await keycloak_auth.startup()
+        yield
+        await keycloak_auth.aclose()
+    
+    app = FastAPI(title="Keycloak Auth Example", lifespan=lifespan)
+    
     @app.get("/api/public")
     async def public_endpoint():
         return {"message": "This is a public endpoint"}
@@ -240,22 +650,43 @@ def create_example_app():
 # Middleware factory function
 @lru_cache()
 def get_keycloak_auth() -> KeycloakOIDCMiddleware:
-    """Get cached instance of Keycloak auth middleware"""
+    """Get the process-wide Keycloak auth middleware.
+
+    The instance starts itself on the first request; call ``startup()`` from
+    the application's lifespan to fail fast instead, and ``aclose()`` on
+    shutdown. Each uvicorn worker is its own process with its own instance; set
+    JWKS_REDIS_URL so workers share one JWKS cache instead of each
+    fetching the key set from Keycloak.
+
+    Anyone with write access to the ``jwks:{realm}`` key can inject signing
+    keys and therefore forge tokens, so treat that Redis as part of the
+    trust boundary (authentication, ACLs, no shared tenants).
+    """
     return KeycloakOIDCMiddleware()
 
 
 """
 Installation:
-pip install fastapi python-jose[cryptography] httpx
+pip install fastapi python-jose[cryptography] httpx[http2]
+pip install orjson  # optional, faster token decoding
+pip install redis   # optional, JWKS cache shared across workers (JWKS_REDIS_URL)
 
 Usage:
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends
 from fastapi_oidc_mw import KeycloakOIDCMiddleware
 
-app = FastAPI()
 keycloak_auth = KeycloakOIDCMiddleware()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await keycloak_auth.startup()
+    yield
+    await keycloak_auth.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
 @app.get("/protected")
 async def protected_route(
     user = Depends(keycloak_auth.require_auth())
@@ -267,4 +698,8 @@ async def admin_route(
     user = Depends(keycloak_auth.require_roles(['admin']))
 ):
     return {"admin_user": user}
+
+# Optional: enforce authentication on every route as a pure ASGI middleware
+# (the verified payload is available as request.state.token_payload)
+app.add_middleware(keycloak_auth.as_asgi_middleware)
 """
\ No newline at end of file
@@ -0,0 +1,443 @@
+"""
+Tests for the FastAPI OIDC middleware, run against real RS256 tokens.
+
+pip install pytest fastapi python-jose[cryptography] httpx[http2]
+pytest middleware-examples/python
+"""
+
+import asyncio
+import base64
+import json
+import time
+
+import httpx
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from fastapi import HTTPException
+from jose import jwk, jwt
+
+from fastapi_oidc_mw import KeycloakOIDCMiddleware
+
+ISSUER = 'http://keycloak.test/realms/project-realm'
+CLIENT_ID = 'project-web'
+KID = 'rsa-1'
+
+_PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+PRIVATE_PEM = _PRIVATE_KEY.private_bytes(
+    serialization.Encoding.PEM,
+    serialization.PrivateFormat.PKCS8,
+    serialization.NoEncryption()
+)
+PUBLIC_JWK = {
+    **jwk.construct(
+        _PRIVATE_KEY.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        ),
+        'RS256'
+    ).to_dict(),
+    'kid': KID,
+    'use': 'sig'
+}
+
+
+def make_token(headers=None, **overrides):
+    claims = {
+        'iss': ISSUER,
+        'aud': CLIENT_ID,
+        'sub': 'user-1',
+        'exp': int(time.time()) + 60,
+        'realm_access': {'roles': ['user']}
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, PRIVATE_PEM, algorithm='RS256', headers={'kid': KID, **(headers or {})})
+
+
+def b64u(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+
+def make_auth(keys=None, jwks_store=None, jwks_calls=None):
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith('/.well-known/openid-configuration'):
+            return httpx.Response(200, json={'issuer': ISSUER, 'jwks_uri': 'http://keycloak.test/certs'})
+        if jwks_calls is not None:
+            jwks_calls.append(request)
+            await asyncio.sleep(0.01)  # Let concurrent refreshes overlap
+        return httpx.Response(200, json={'keys': keys if keys is not None else [PUBLIC_JWK]})
+
+    auth = KeycloakOIDCMiddleware(
+        keycloak_url='http://keycloak.test',
+        realm='project-realm',
+        client_id=CLIENT_ID,
+        jwks_store=jwks_store
+    )
+    auth._http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return auth
+
+
+def validate(token, auth=None):
+    async def run():
+        keycloak_auth = auth or make_auth()
+        try:
+            await keycloak_auth.startup()
+            return await keycloak_auth.validate_token(token)
+        finally:
+            await keycloak_auth.aclose()
+    return asyncio.run(run())
+
+
+def assert_rejected(token, detail):
+    with pytest.raises(HTTPException) as excinfo:
+        validate(token)
+    assert excinfo.value.status_code == 401
+    assert excinfo.value.detail == f"Token validation failed: {detail}"
+
+
+def test_valid_token():
+    payload = validate(make_token())
+    assert payload['sub'] == 'user-1'
+    assert payload['realm_access']['roles'] == ['user']
+
+
+def test_audience_list():
+    assert validate(make_token(aud=['account', CLIENT_ID]))['sub'] == 'user-1'
+
+
+def test_expired_token():
+    assert_rejected(make_token(exp=int(time.time()) - 10), "Signature has expired.")
+
+
+def test_not_yet_valid_token():
+    assert_rejected(make_token(nbf=int(time.time()) + 600), "The token is not yet valid (nbf)")
+
+
+def test_wrong_audience():
+    assert_rejected(make_token(aud='other-client'), "Invalid audience")
+
+
+def test_non_string_audience_element():
+    assert_rejected(make_token(aud=[CLIENT_ID, 42]), "Invalid claim format in token")
+
+
+def test_wrong_issuer():
+    assert_rejected(make_token(iss='http://evil.test/realms/project-realm'), "Invalid issuer")
+
+
+def test_non_string_sub_and_jti():
+    assert_rejected(make_token(sub=123), "Subject must be a string.")
+    assert_rejected(make_token(jti=123), "JWT ID must be a string.")
+
+
+def test_non_integer_exp():
+    assert_rejected(make_token(exp='soon'), "Expiration Time claim (exp) must be an integer.")
+
+
+def test_tampered_signature():
+    header, claims, signature = make_token().split('.')
+    forged_claims = b64u({**jwt.get_unverified_claims(make_token()), 'realm_access': {'roles': ['admin']}})
+    assert_rejected(f"{header}.{forged_claims}.{signature}", "Signature verification failed.")
+
+
+def test_alg_none():
+    token = f"{b64u({'alg': 'none', 'kid': KID})}.{b64u({'iss': ISSUER, 'aud': CLIENT_ID})}."
+    assert_rejected(token, "The specified alg value is not allowed")
+
+
+def test_malformed_token():
+    assert_rejected('not-a-jwt', "Malformed token")
+    assert_rejected('a.b', "Malformed token")
+    assert_rejected('!!!.@@@.###', "Malformed token")
+
+
+def test_non_string_kid():
+    assert_rejected(make_token(headers={'kid': [KID]}), "Invalid 'kid' in header")
+
+
+def test_unknown_kid():
+    assert_rejected(make_token(headers={'kid': 'rotated-away'}), "Unable to find key 'rotated-away' in JWKS")
+
+
+def test_cached_payload_is_not_shared_between_requests():
+    async def run():
+        auth = make_auth()
+        try:
+            await auth.startup()
+            token = make_token()
+            first = await auth.validate_token(token)
+            first['realm_access']['roles'].append('admin')
+            second = await auth.validate_token(token)
+            assert second['realm_access']['roles'] == ['user']
+            second['realm_access']['roles'].append('admin')
+            third = await auth.validate_token(token)
+            assert third['realm_access']['roles'] == ['user']
+        finally:
+            await auth.aclose()
+    asyncio.run(run())
+
+
+def test_failed_jwks_refresh_backs_off():
+    async def run():
+        jwks_calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path.endswith('/.well-known/openid-configuration'):
+                return httpx.Response(200, json={'issuer': ISSUER, 'jwks_uri': 'http://keycloak.test/certs'})
+            jwks_calls.append(request)
+            if len(jwks_calls) == 1:
+                return httpx.Response(200, json={'keys': [PUBLIC_JWK]})
+            return httpx.Response(503)
+
+        auth = KeycloakOIDCMiddleware(keycloak_url='http://keycloak.test', client_id=CLIENT_ID)
+        auth._http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            await auth.startup()
+            await auth.get_jwks_keys()
+            auth.jwks_last_fetch = 0  # Expire the cached keys
+            for _ in range(5):
+                assert KID in await auth.get_jwks_keys()
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        finally:
+            await auth.aclose()
+        return len(jwks_calls)
+    assert asyncio.run(run()) == 2
+
+
+def test_asgi_middleware_per_app():
+    from fastapi import FastAPI, Request
+    from fastapi.testclient import TestClient
+
+    auth = make_auth()
+    asyncio.run(auth.startup())
+
+    def build(name):
+        app = FastAPI()
+
+        @app.get("/whoami")
+        async def whoami(request: Request):
+            return {"app": name, "sub": request.state.token_payload['sub']}
+
+        app.add_middleware(auth.as_asgi_middleware)
+        return app
+
+    first, second = build("first"), build("second")
+    headers = {"Authorization": f"Bearer {make_token()}"}
+    with TestClient(first) as client:
+        assert client.get("/whoami").status_code == 401
+        assert client.get("/whoami", headers=headers).json() == {"app": "first", "sub": "user-1"}
+    with TestClient(second) as client:
+        assert client.get("/whoami", headers=headers).json() == {"app": "second", "sub": "user-1"}
+    asyncio.run(auth.aclose())
+
+
+def test_non_rsa_jwks_keys_are_skipped():
+    ec_key = {
+        'kty': 'EC', 'crv': 'P-256', 'kid': 'ec-1', 'use': 'sig', 'alg': 'ES256',
+        'x': 'f83OJ3D2xF1Bg8vub9tLe1gHMzV76e8Tus9uPHvRVEU',
+        'y': 'x_FEzRu9m36HLN_tue659LNpXW6pCyStikYjKIWI5a0'
+    }
+    auth = make_auth(keys=[ec_key, PUBLIC_JWK])
+    assert validate(make_token(), auth)['sub'] == 'user-1'
+
+
+def test_starts_lazily_without_lifespan():
+    async def run():
+        auth = make_auth()
+        try:
+            token = make_token()
+            results = await asyncio.gather(auth.validate_token(token), auth.validate_token(token))
+            return [payload['sub'] for payload in results]
+        finally:
+            await auth.aclose()
+    assert asyncio.run(run()) == ['user-1', 'user-1']
+
+
+def test_failed_lazy_start_returns_503_and_backs_off():
+    async def run():
+        discovery_calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            discovery_calls.append(request)
+            return httpx.Response(503)
+
+        auth = KeycloakOIDCMiddleware(keycloak_url='http://keycloak.test', client_id=CLIENT_ID)
+        auth._http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            for _ in range(3):
+                with pytest.raises(HTTPException) as excinfo:
+                    await auth.validate_token(make_token())
+                assert excinfo.value.status_code == 503
+        finally:
+            await auth.aclose()
+        return len(discovery_calls)
+    assert asyncio.run(run()) == 1
+
+
+class MemoryJWKSStore:
+    def __init__(self, lock_ttl=10):
+        self.entry = None
+        self.lock_ttl = lock_ttl
+        self.locked_until = 0.0
+
+    async def get_all(self):
+        return self.entry
+
+    async def set_many(self, keys, fetched_at):
+        self.entry = (keys, fetched_at)
+
+    async def acquire_refresh_lock(self):
+        if time.time() < self.locked_until:
+            return False
+        self.locked_until = time.time() + self.lock_ttl
+        return True
+
+    async def aclose(self):
+        pass
+
+
+def test_shared_jwks_store_keeps_original_fetch_time():
+    async def run():
+        store = MemoryJWKSStore()
+        first, second = make_auth(jwks_store=store), make_auth(jwks_store=store)
+        try:
+            await first.startup()
+            await first.get_jwks_keys()
+            fetched_at = store.entry[1]
+
+            await second.startup()
+            await second._http.aclose()  # Any Keycloak JWKS fetch would now fail
+            assert KID in await second.get_jwks_keys()
+            assert second.jwks_last_fetch == fetched_at
+
+            # A shared entry older than the TTL is ignored
+            store.entry = (store.entry[0], time.time() - second.jwks_cache_ttl - 1)
+            second.jwks_last_fetch = 0
+            second.jwks_keys = {}
+            with pytest.raises(RuntimeError):
+                await second.get_jwks_keys()
+        finally:
+            await first.aclose()
+    asyncio.run(run())
+
+
+def test_non_finite_numeric_dates_with_stdlib_json(monkeypatch):
+    import fastapi_oidc_mw
+    monkeypatch.setattr(fastapi_oidc_mw, '_json_loads', json.loads)
+
+    header = b64u({'alg': 'RS256', 'kid': KID})
+    for claims in ('{"exp": 1e400}', '{"exp": NaN}', '{"exp": -Infinity}'):
+        unsigned = base64.urlsafe_b64encode(claims.encode()).rstrip(b'=').decode()
+        assert_rejected(f"{header}.{unsigned}.AAAA", "Malformed token")
+
+    assert_rejected(make_token(nbf=float('inf')), "Not Before claim (nbf) must be an integer.")
+
+
+def test_numeric_string_exp_is_accepted_and_cached():
+    async def run():
+        auth = make_auth()
+        try:
+            await auth.startup()
+            token = make_token(exp=str(int(time.time()) + 60))
+            first = await auth.validate_token(token)
+            second = await auth.validate_token(token)
+            return first['sub'], second['sub'], len(auth._payload_cache)
+        finally:
+            await auth.aclose()
+    assert asyncio.run(run()) == ('user-1', 'user-1', 1)
+
+
+def test_shared_jwks_refresh_is_single_flight_across_workers():
+    async def run():
+        store = MemoryJWKSStore()
+        jwks_calls = []
+        workers = [make_auth(jwks_store=store, jwks_calls=jwks_calls) for _ in range(2)]
+        try:
+            for worker in workers:
+                await worker.startup()
+                await worker.get_jwks_keys()
+            assert len(jwks_calls) == 1
+
+            # Every worker's keys and the shared entry go stale at the same instant
+            expired = time.time() - workers[0].jwks_cache_ttl
+            store.entry = (store.entry[0], expired)
+            store.locked_until = 0.0
+            for worker in workers:
+                worker.jwks_last_fetch = expired
+
+            for _ in range(3):
+                for worker in workers:
+                    assert KID in await worker.get_jwks_keys()
+                    worker._jwks_retry_at = 0.0  # Skip the poll interval
+                await asyncio.gather(*(
+                    worker._jwks_refresh_task for worker in workers if worker._jwks_refresh_task
+                ))
+
+            assert len(jwks_calls) == 2
+            assert all(worker.jwks_last_fetch == store.entry[1] for worker in workers)
+        finally:
+            for worker in workers:
+                await worker.aclose()
+    asyncio.run(run())
+
+
+def test_has_role():
+    auth = KeycloakOIDCMiddleware(client_id=CLIENT_ID)
+    payload = {'realm_access': {'roles': ['user', 'ops']}}
+    assert auth.has_role(payload, ['admin', 'ops'])
+    assert not auth.has_role(payload, ['admin'])
+    assert not auth.has_role({}, ['admin'])
+    assert auth.has_role({}, [])
+    asyncio.run(auth.aclose())
+
+
+def test_require_roles_routes():
+    from fastapi import Depends, FastAPI
+    from fastapi.testclient import TestClient
+
+    auth = make_auth()
+    app = FastAPI()
+
+    @app.get("/admin")
+    async def admin(user=Depends(auth.require_roles(['admin', 'ops']))):
+        return {"id": user['id']}
+
+    @app.get("/any")
+    async def any_role(user=Depends(auth.require_roles([]))):
+        return {"id": user['id']}
+
+    user_headers = {"Authorization": f"Bearer {make_token()}"}
+    admin_headers = {"Authorization": f"Bearer {make_token(sub='admin-1', realm_access={'roles': ['admin']})}"}
+    with TestClient(app) as client:
+        denied = client.get("/admin", headers=user_headers)
+        assert denied.status_code == 403
+        assert denied.json() == {"detail": "Access denied. Required roles: admin, ops"}
+        assert client.get("/admin", headers=user_headers).json() == denied.json()
+        assert client.get("/admin", headers=admin_headers).json() == {"id": "admin-1"}
+
+        # An empty role list only requires authentication
+        assert client.get("/any", headers=user_headers).json() == {"id": "user-1"}
+        assert client.get("/any").status_code == 401
+    asyncio.run(auth.aclose())
+
+
+def test_single_openapi_security_scheme():
+    from fastapi import Depends, FastAPI
+
+    auth = KeycloakOIDCMiddleware(client_id=CLIENT_ID)
+    app = FastAPI()
+
+    @app.get("/optional")
+    async def optional(user=Depends(auth.optional_auth())):
+        return {}
+
+    @app.get("/protected")
+    async def protected(user=Depends(auth.require_auth())):
+        return {}
+
+    schema = app.openapi()
+    assert schema['components']['securitySchemes'] == {'HTTPBearer': {'type': 'http', 'scheme': 'bearer'}}
+    assert schema['paths']['/optional']['get']['security'] == [{'HTTPBearer': []}]
+    assert schema['paths']['/protected']['get']['security'] == [{'HTTPBearer': []}]
+    asyncio.run(auth.aclose())